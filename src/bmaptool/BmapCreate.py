@@ -39,7 +39,8 @@ etc. The end result should be a sparse file where mapped areas represent useful
 parts of the image and holes represent useless parts of the image, which do not
 have to be copied when copying the image to the target device.
 
-This module uses the FIEMAP ioctl to detect holes.
+This module uses the 'SEEK_HOLE' and 'SEEK_DATA' features of the file seek
+system call to detect holes, or the FIEMAP ioctl if they are not supported.
 """
 
 # Disable the following pylint recommendations:
@@ -47,6 +48,7 @@ This module uses the FIEMAP ioctl to detect holes.
 #   *  Too few public methods - R0903
 # pylint: disable=R0902,R0903
 
+import os
 import hashlib
 from .BmapHelpers import human_size
 from . import Filemap
@@ -121,7 +123,8 @@ class BmapCreate(object):
     * full path or a file object to use for writing the results to
 
     Then you should invoke the 'generate()' method of this class. It will use
-    the FIEMAP ioctl to generate the bmap.
+    'SEEK_HOLE' and 'SEEK_DATA', or the FIEMAP ioctl if they are not supported,
+    to generate the bmap.
     """
 
     def __init__(self, image, bmap, chksum_type="sha256"):
@@ -297,6 +300,22 @@ class BmapCreate(object):
         self._f_bmap.seek(self._chksum_pos)
         self._f_bmap.write("%s" % chksum)
 
+    def _fadvise_image(self, advice):
+        """
+        A helper function which gives the kernel the 'advice' hint (the name
+        of an 'os.POSIX_FADV_*' constant) about how the image file is going to
+        be accessed. This is only a hint, so it is silently skipped if not
+        supported or if it fails.
+        """
+
+        if not hasattr(os, "posix_fadvise"):
+            return
+
+        try:
+            os.posix_fadvise(self._f_image.fileno(), 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
     def _calculate_chksum(self, first, last):
         """
         A helper function which calculates checksum for the range of blocks of
@@ -333,33 +352,45 @@ class BmapCreate(object):
 
         self._bmap_file_start()
 
-        # Generate the block map and write it to the XML block map
-        # file as we go.
-        self.mapped_cnt = 0
-        for first, last in self.filemap.get_mapped_ranges(0, self.blocks_cnt):
-            self.mapped_cnt += last - first + 1
-            if include_checksums:
-                chksum = self._calculate_chksum(first, last)
-                chksum = ' chksum="%s"' % chksum
-            else:
-                chksum = ""
-
-            if first != last:
-                self._f_bmap.write(
-                    "        <Range%s> %s-%s </Range>\n" % (chksum, first, last)
-                )
-            else:
-                self._f_bmap.write("        <Range%s> %s </Range>\n" % (chksum, first))
-
-        self.mapped_size = self.mapped_cnt * self.block_size
-        self.mapped_size_human = human_size(self.mapped_size)
-        self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
-
-        self._bmap_file_end()
+        # The mapped areas of the image file are read sequentially when
+        # calculating checksums, so let the kernel know
+        if include_checksums:
+            self._fadvise_image("POSIX_FADV_SEQUENTIAL")
 
         try:
-            self._f_bmap.flush()
-        except IOError as err:
-            raise Error("cannot flush the bmap file '%s': %s" % (self._bmap_path, err))
-
-        self._f_image.seek(image_pos)
+            # Generate the block map and write it to the XML block map
+            # file as we go.
+            self.mapped_cnt = 0
+            for first, last in self.filemap.get_mapped_ranges(0, self.blocks_cnt):
+                self.mapped_cnt += last - first + 1
+                if include_checksums:
+                    chksum = self._calculate_chksum(first, last)
+                    chksum = ' chksum="%s"' % chksum
+                else:
+                    chksum = ""
+
+                if first != last:
+                    self._f_bmap.write(
+                        "        <Range%s> %s-%s </Range>\n" % (chksum, first, last)
+                    )
+                else:
+                    self._f_bmap.write(
+                        "        <Range%s> %s </Range>\n" % (chksum, first)
+                    )
+
+            self.mapped_size = self.mapped_cnt * self.block_size
+            self.mapped_size_human = human_size(self.mapped_size)
+            self.mapped_percent = (self.mapped_cnt * 100.0) / self.blocks_cnt
+
+            self._bmap_file_end()
+
+            try:
+                self._f_bmap.flush()
+            except IOError as err:
+                raise Error(
+                    "cannot flush the bmap file '%s': %s" % (self._bmap_path, err)
+                )
+        finally:
+            if include_checksums:
+                self._fadvise_image("POSIX_FADV_NORMAL")
+            self._f_image.seek(image_pos)
@@ -66,8 +66,8 @@ def human_time(seconds):
 
 def get_block_size(file_obj):
     """
-    Return block size for file object 'file_obj'. Errors are indicated by the
-    'IOError' exception.
+    Return block size for file object or file descriptor 'file_obj'. Errors are
+    indicated by the 'IOError' exception.
     """
 
     # Get the block size of the host file-system for the image file by calling
@@ -78,7 +78,9 @@ def get_block_size(file_obj):
         if not bsize:
             raise IOError("get 0 bsize by FIGETBSZ ioctl")
     except IOError as err:
-        stat = os.fstat(file_obj.fileno())
+        if hasattr(file_obj, "fileno"):
+            file_obj = file_obj.fileno()
+        stat = os.fstat(file_obj)
         if hasattr(stat, "st_blksize"):
             bsize = stat.st_blksize
         else:
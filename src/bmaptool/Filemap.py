@@ -20,7 +20,7 @@ are supported - the FIEMAP ioctl and the 'SEEK_HOLE / SEEK_DATA' features of
 the file seek syscall. The former is implemented by the 'FilemapFiemap' class,
 the latter is implemented by the 'FilemapSeek' class. Both classes provide the
 same API. The 'filemap' function automatically selects which class can be used
-and returns an instance of the class.
+(preferring 'FilemapSeek') and returns an instance of the class.
 """
 
 # Disable the following pylint recommendations:
@@ -30,10 +30,11 @@ and returns an instance of the class.
 import os
 import errno
 import struct
-import array
+import bisect
 import fcntl
 import tempfile
 import logging
+import weakref
 from . import BmapHelpers
 
 _log = logging.getLogger(__name__)  # pylint: disable=C0103
@@ -61,47 +62,90 @@ class _FilemapBase(object):
     the image file, gets its size, etc.
     """
 
-    def __init__(self, image):
+    def __init__(self, image, sync=True):
         """
         Initialize a class instance. The 'image' argument is full path to the
         file or file object to operate on.
+
+        By default, the image file is synchronized before its block map is
+        read. The page cache is shared, so this also flushes dirty data left
+        by whatever program has just written the image (even if the file is
+        open read-only here), which works-around kernel bugs in reporting the
+        block map of such data. The caller may pass 'sync=False' if it knows
+        that the image file has no dirty data.
+
+        If the image file is opened by this class, it has to be closed with
+        'close()'. Alternatively, the instance can be used as a context
+        manager, which closes the file on exit. Otherwise, the file is only
+        closed when the instance is garbage collected.
         """
 
-        self._f_image_needs_close = False
+        # The finalizer which closes 'self._fd' if it was opened by this class
+        self._fd_finalizer = None
 
+        # The image is accessed via the raw file descriptor 'self._fd' only, so
+        # there is no buffering to construct or check. 'self._f_image' is the
+        # file object passed by the caller, or 'None'.
         if hasattr(image, "fileno"):
             self._f_image = image
             self._image_path = image.name
+            self._fd = image.fileno()
         else:
+            self._f_image = None
             self._image_path = image
             self._open_image_file()
 
+        # Make sure the image file is not left open if something fails, since
+        # the caller gets no object to call 'close()' on
+        try:
+            self._inspect_image_file(sync)
+        except Exception:
+            self.close()
+            raise
+
+        _log.debug('opened image "%s"' % self._image_path)
+        _log.debug(
+            "block size %d, blocks count %d, image size %d"
+            % (self.block_size, self.blocks_cnt, self.image_size)
+        )
+
+    def _inspect_image_file(self, sync):
+        """
+        Get the size and the block size of the image file, synchronize it if
+        needed, and check that it is on a compatible file-system. The 'sync'
+        argument is described in '__init__()'.
+        """
+
         try:
-            self.image_size = os.fstat(self._f_image.fileno()).st_size
+            self.image_size = os.fstat(self._fd).st_size
         except IOError as err:
             raise Error(
-                "cannot get information about file '%s': %s" % (self._f_image.name, err)
+                "cannot get information about file '%s': %s" % (self._image_path, err)
             )
 
         try:
-            self.block_size = BmapHelpers.get_block_size(self._f_image)
+            self.block_size = BmapHelpers.get_block_size(self._fd)
         except IOError as err:
             raise Error("cannot get block size for '%s': %s" % (self._image_path, err))
 
         self.blocks_cnt = (self.image_size + self.block_size - 1) // self.block_size
 
-        try:
-            self._f_image.flush()
-        except IOError as err:
-            raise Error("cannot flush image file '%s': %s" % (self._image_path, err))
-
-        try:
-            os.fsync(self._f_image.fileno()),
-        except OSError as err:
-            raise Error(
-                "cannot synchronize image file '%s': %s "
-                % (self._image_path, err.strerror)
-            )
+        if sync:
+            if self._f_image is not None:
+                try:
+                    self._f_image.flush()
+                except IOError as err:
+                    raise Error(
+                        "cannot flush image file '%s': %s" % (self._image_path, err)
+                    )
+
+            try:
+                os.fsync(self._fd),
+            except OSError as err:
+                raise Error(
+                    "cannot synchronize image file '%s': %s "
+                    % (self._image_path, err.strerror)
+                )
 
         if not BmapHelpers.is_compatible_file_system(self._image_path):
             fstype = BmapHelpers.get_file_system_type(self._image_path)
@@ -110,25 +154,52 @@ class _FilemapBase(object):
                 % (self._image_path, fstype)
             )
 
-        _log.debug('opened image "%s"' % self._image_path)
-        _log.debug(
-            "block size %d, blocks count %d, image size %d"
-            % (self.block_size, self.blocks_cnt, self.image_size)
-        )
+    def close(self):
+        """
+        Close the image file if it was opened by this class. File objects
+        passed by the caller are not closed. The instance cannot be used after
+        it was closed.
+        """
+
+        if self._fd_finalizer is not None:
+            self._fd_finalizer()
+        # Drop the descriptor, so that using a closed instance fails instead of
+        # acting on whatever file reuses the descriptor number
+        self._fd = None
 
-    def __del__(self):
-        """The class destructor which just closes the image file."""
-        if self._f_image_needs_close:
-            self._f_image.close()
+    def __enter__(self):
+        """Enter the runtime context, returns the instance itself."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Exit the runtime context, closes the image file."""
+        self.close()
 
     def _open_image_file(self):
         """Open the image file."""
         try:
-            self._f_image = open(self._image_path, "rb")
-        except IOError as err:
+            self._fd = os.open(self._image_path, os.O_RDONLY)
+        except OSError as err:
             raise Error("cannot open image file '%s': %s" % (self._image_path, err))
 
-        self._f_image_needs_close = True
+        # As a last resort, close the file when the instance is garbage
+        # collected, in case the caller forgets to call 'close()'
+        self._fd_finalizer = weakref.finalize(self, os.close, self._fd)
+
+    def _check_block(self, block):
+        """
+        Raise an 'Error' type exception if the instance was closed or 'block'
+        is not a valid block number of the image file.
+        """
+
+        if self._fd is None:
+            raise Error("image file '%s' is closed" % self._image_path)
+
+        if self.blocks_cnt != 0 and (block < 0 or block >= self.blocks_cnt):
+            raise Error(
+                "bad block number %d, should be within [0, %d]"
+                % (block, self.blocks_cnt)
+            )
 
     def block_is_mapped(self, block):  # pylint: disable=W0613,R0201
         """
@@ -176,15 +247,15 @@ _SEEK_DATA = 3
 _SEEK_HOLE = 4
 
 
-def _lseek(file_obj, offset, whence):
-    """This is a helper function which invokes 'os.lseek' for file object
-    'file_obj' and with specified 'offset' and 'whence'. The 'whence'
+def _lseek(fd, offset, whence):
+    """This is a helper function which invokes 'os.lseek' for file descriptor
+    'fd' and with specified 'offset' and 'whence'. The 'whence'
     argument is supposed to be either '_SEEK_DATA' or '_SEEK_HOLE'. When
     there is no more data or hole starting from 'offset', this function
     returns '-1'.  Otherwise, the data or hole position is returned."""
 
     try:
-        return os.lseek(file_obj.fileno(), offset, whence)
+        return os.lseek(fd, offset, whence)
     except OSError as err:
         # The 'lseek' system call returns the ENXIO if there is no data or
         # hole starting from the specified offset.
@@ -204,16 +275,29 @@ class FilemapSeek(_FilemapBase):
     This class uses the 'SEEK_HOLE' and 'SEEK_DATA' to find file block mapping.
     Unfortunately, the current implementation requires the caller to have write
     access to the image file.
+
+    The last found data area of the file is cached by 'block_is_mapped()', so
+    the image file must not be modified while an instance of this class is in
+    use.
     """
 
-    def __init__(self, image):
+    def __init__(self, image, sync=True):
         """Refer to the '_FilemapBase' class for the documentation."""
 
         # Call the base class constructor first
-        _FilemapBase.__init__(self, image)
+        _FilemapBase.__init__(self, image, sync)
         _log.debug("FilemapSeek: initializing")
 
-        self._probe_seek_hole()
+        # The '(start, end)' byte offsets of the data area found by the last
+        # 'block_is_mapped()' call which had to run 'SEEK_DATA'. Sequential
+        # probes of blocks within this area are answered without system calls.
+        self._last_data = (0, 0)
+
+        try:
+            self._probe_seek_hole()
+        except Exception:
+            self.close()
+            raise
 
     def _probe_seek_hole(self):
         """
@@ -245,7 +329,7 @@ class FilemapSeek(_FilemapBase):
                 'cannot truncate temporary file in "%s": %s' % (directory, err)
             )
 
-        offs = _lseek(tmp_obj, 0, _SEEK_HOLE)
+        offs = _lseek(tmp_obj.fileno(), 0, _SEEK_HOLE)
         if offs != 0:
             # We are dealing with the stub 'SEEK_HOLE' implementation which
             # always returns EOF.
@@ -260,11 +344,22 @@ class FilemapSeek(_FilemapBase):
 
     def block_is_mapped(self, block):
         """Refer to the '_FilemapBase' class for the documentation."""
-        offs = _lseek(self._f_image, block * self.block_size, _SEEK_DATA)
-        if offs == -1:
-            result = False
+        self._check_block(block)
+
+        offs = block * self.block_size
+        if self._last_data[0] <= offs < self._last_data[1]:
+            result = True
         else:
-            result = offs // self.block_size == block
+            data = _lseek(self._fd, offs, _SEEK_DATA)
+            if data == -1:
+                result = False
+            else:
+                result = data // self.block_size == block
+                if result:
+                    hole = _lseek(self._fd, data, _SEEK_HOLE)
+                    if hole == -1:
+                        hole = self.image_size
+                    self._last_data = (data, hole)
 
         _log.debug("FilemapSeek: block_is_mapped(%d) returns %s" % (block, result))
         return result
@@ -281,15 +376,20 @@ class FilemapSeek(_FilemapBase):
         """
 
         assert whence1 != whence2
+
+        if count <= 0:
+            return
+
+        self._check_block(start)
         end = start * self.block_size
         limit = end + count * self.block_size
 
         while True:
-            start = _lseek(self._f_image, end, whence1)
+            start = _lseek(self._fd, end, whence1)
             if start == -1 or start >= limit or start == self.image_size:
                 break
 
-            end = _lseek(self._f_image, start, whence2)
+            end = _lseek(self._fd, start, whence2)
             if end == -1 or end == self.image_size:
                 end = self.blocks_cnt * self.block_size
             if end > limit:
@@ -324,21 +424,28 @@ class FilemapSeek(_FilemapBase):
 
 # Format string for 'struct fiemap'
 _FIEMAP_FORMAT = "=QQLLLL"
+# Pre-compiled packer/unpacker for 'struct fiemap'
+_FIEMAP_STRUCT = struct.Struct(_FIEMAP_FORMAT)
 # sizeof(struct fiemap)
-_FIEMAP_SIZE = struct.calcsize(_FIEMAP_FORMAT)
+_FIEMAP_SIZE = _FIEMAP_STRUCT.size
 # Format string for 'struct fiemap_extent'
 _FIEMAP_EXTENT_FORMAT = "=QQQQQLLLL"
+# Pre-compiled unpacker for 'struct fiemap_extent'
+_FIEMAP_EXTENT_STRUCT = struct.Struct(_FIEMAP_EXTENT_FORMAT)
 # sizeof(struct fiemap_extent)
-_FIEMAP_EXTENT_SIZE = struct.calcsize(_FIEMAP_EXTENT_FORMAT)
+_FIEMAP_EXTENT_SIZE = _FIEMAP_EXTENT_STRUCT.size
 # The FIEMAP ioctl number
 _FIEMAP_IOCTL = 0xC020660B
 # This FIEMAP ioctl flag which instructs the kernel to sync the file before
 # reading the block map
 _FIEMAP_FLAG_SYNC = 0x00000001
-# Size of the buffer for 'struct fiemap_extent' elements which will be used
-# when invoking the FIEMAP ioctl. With a larger buffer, the FIEMAP ioctl will
-# be invoked fewer times.
-_FIEMAP_BUFFER_SIZE = 256 * 1024
+# This 'struct fiemap_extent' flag marks the last extent of the file
+_FIEMAP_EXTENT_LAST = 0x00000001
+# Minimum size of the buffer for 'struct fiemap_extent' elements which will be
+# used when invoking the FIEMAP ioctl. The buffer is grown if the file has more
+# extents than fit into it. With a larger buffer, the FIEMAP ioctl will be
+# invoked fewer times.
+_FIEMAP_BUFFER_SIZE = 1024 * 1024
 
 
 class FilemapFiemap(_FilemapBase):
@@ -346,34 +453,65 @@ class FilemapFiemap(_FilemapBase):
     This class provides API to the FIEMAP ioctl. Namely, it allows to iterate
     over all mapped blocks and over all holes.
 
-    This class synchronizes the image file every time it invokes the FIEMAP
-    ioctl in order to work-around early FIEMAP implementation kernel bugs.
+    Unless the 'sync' argument is 'False', the image file is synchronized once
+    by the '_FilemapBase' constructor in order to work-around early FIEMAP
+    implementation kernel bugs related to cached dirty data, so the FIEMAP
+    ioctl is invoked without '_FIEMAP_FLAG_SYNC'.
+
+    The block map of the entire file is read once and cached, so the image
+    file must not be modified while an instance of this class is in use.
     """
 
-    def __init__(self, image):
+    def __init__(self, image, sync=True):
         """
-        Initialize a class instance. The 'image' argument is the file object
-        to operate on.
+        Initialize a class instance. The 'image' and 'sync' arguments are
+        described in the '_FilemapBase' class.
         """
 
         # Call the base class constructor first
-        _FilemapBase.__init__(self, image)
+        _FilemapBase.__init__(self, image, sync)
         _log.debug("FilemapFiemap: initializing")
 
-        self._buf_size = _FIEMAP_BUFFER_SIZE
-
         # Calculate how many 'struct fiemap_extent' elements fit the buffer
-        self._buf_size -= _FIEMAP_SIZE
-        self._fiemap_extent_cnt = self._buf_size // _FIEMAP_EXTENT_SIZE
+        self._fiemap_extent_cnt = (
+            _FIEMAP_BUFFER_SIZE - _FIEMAP_SIZE
+        ) // _FIEMAP_EXTENT_SIZE
         assert self._fiemap_extent_cnt > 0
-        self._buf_size = self._fiemap_extent_cnt * _FIEMAP_EXTENT_SIZE
-        self._buf_size += _FIEMAP_SIZE
+        self._alloc_buf()
+
+        # The cached lists of mapped extents and holes, see '_get_extents()'
+        # and '_get_holes()'
+        self._extents = None
+        self._holes = None
+
+        # Find out how many extents the file has by requesting zero extents
+        # for the entire file, and grow the buffer if they do not fit, so that
+        # a full scan takes a single FIEMAP ioctl invocation. The kernel only
+        # counts the extents in this case, which also makes this a cheap check
+        # whether the FIEMAP ioctl is supported at all.
+        fiemap_extent_cnt = self._fiemap_extent_cnt
+        self._fiemap_extent_cnt = 0
+        try:
+            mapped_extents = self._invoke_fiemap(0, max(self.blocks_cnt, 1))[3]
+        except Exception:
+            self.close()
+            raise
+        finally:
+            self._fiemap_extent_cnt = fiemap_extent_cnt
 
-        # Allocate a mutable buffer for the FIEMAP ioctl
-        self._buf = array.array("B", [0] * self._buf_size)
+        if mapped_extents > self._fiemap_extent_cnt:
+            self._fiemap_extent_cnt = mapped_extents
+            self._alloc_buf()
 
-        # Check if the FIEMAP ioctl is supported
-        self.block_is_mapped(0)
+    def _alloc_buf(self):
+        """
+        Allocate a mutable buffer for the FIEMAP ioctl which fits the
+        'struct fiemap' header and 'self._fiemap_extent_cnt' elements of
+        'struct fiemap_extent'.
+        """
+
+        self._buf_size = _FIEMAP_SIZE + self._fiemap_extent_cnt * _FIEMAP_EXTENT_SIZE
+        self._buf = bytearray(self._buf_size)
 
     def _invoke_fiemap(self, block, count):
         """
@@ -382,34 +520,27 @@ class FilemapFiemap(_FilemapBase):
 
         The full result of the operation is stored in 'self._buf' on exit.
         Returns the unpacked 'struct fiemap' data structure in form of a python
-        list (just like 'struct.upack()').
+        tuple (just like 'struct.unpack()').
         """
 
-        if self.blocks_cnt != 0 and (block < 0 or block >= self.blocks_cnt):
-            raise Error(
-                "bad block number %d, should be within [0, %d]"
-                % (block, self.blocks_cnt)
-            )
+        self._check_block(block)
 
-        # Initialize the 'struct fiemap' part of the buffer. We use the
-        # '_FIEMAP_FLAG_SYNC' flag in order to make sure the file is
-        # synchronized. The reason for this is that early FIEMAP
-        # implementations had many bugs related to cached dirty data, and
-        # synchronizing the file is a necessary work-around.
-        struct.pack_into(
-            _FIEMAP_FORMAT,
+        # Initialize the 'struct fiemap' part of the buffer. There is no need
+        # for the '_FIEMAP_FLAG_SYNC' flag, because the file was synchronized
+        # by the '_FilemapBase' constructor (unless the caller asked not to).
+        _FIEMAP_STRUCT.pack_into(
             self._buf,
             0,
             block * self.block_size,
             count * self.block_size,
-            _FIEMAP_FLAG_SYNC,
+            0,
             0,
             self._fiemap_extent_cnt,
             0,
         )
 
         try:
-            fcntl.ioctl(self._f_image, _FIEMAP_IOCTL, self._buf, 1)
+            fcntl.ioctl(self._fd, _FIEMAP_IOCTL, self._buf, 1)
         except IOError as err:
             # Note, the FIEMAP ioctl is supported by the Linux kernel starting
             # from version 2.6.28 (year 2008).
@@ -430,16 +561,15 @@ class FilemapFiemap(_FilemapBase):
                 "the FIEMAP ioctl failed for '%s': %s" % (self._image_path, err)
             )
 
-        return struct.unpack(_FIEMAP_FORMAT, self._buf[:_FIEMAP_SIZE])
+        return _FIEMAP_STRUCT.unpack_from(self._buf)
 
     def block_is_mapped(self, block):
         """Refer to the '_FilemapBase' class for the documentation."""
-        struct_fiemap = self._invoke_fiemap(block, 1)
+        self._check_block(block)
 
-        # The 3rd element of 'struct_fiemap' is the 'fm_mapped_extents' field.
-        # If it contains zero, the block is not mapped, otherwise it is
-        # mapped.
-        result = bool(struct_fiemap[3])
+        extents = self._get_extents()
+        index = _find_range(extents, block)
+        result = index >= 0 and extents[index][1] >= block
         _log.debug("FilemapFiemap: block_is_mapped(%d) returns %s" % (block, result))
         return result
 
@@ -447,26 +577,28 @@ class FilemapFiemap(_FilemapBase):
         """Refer to the '_FilemapBase' class for the documentation."""
         return not self.block_is_mapped(block)
 
-    def _unpack_fiemap_extent(self, index):
+    def _unpack_fiemap_extents(self, count):
         """
-        Unpack a 'struct fiemap_extent' structure object number 'index' from
-        the internal 'self._buf' buffer.
+        Return an iterator which unpacks the first 'count' 'struct
+        fiemap_extent' structure objects from the internal 'self._buf' buffer.
+        The unpacking is done by the 'struct' module in C, without copying the
+        buffer.
         """
 
-        offset = _FIEMAP_SIZE + _FIEMAP_EXTENT_SIZE * index
-        return struct.unpack(
-            _FIEMAP_EXTENT_FORMAT, self._buf[offset : offset + _FIEMAP_EXTENT_SIZE]
+        end = _FIEMAP_SIZE + _FIEMAP_EXTENT_SIZE * count
+        return _FIEMAP_EXTENT_STRUCT.iter_unpack(
+            memoryview(self._buf)[_FIEMAP_SIZE:end]
         )
 
     def _do_get_mapped_ranges(self, start, count):
         """
-        Implements most the functionality for the  'get_mapped_ranges()'
-        generator: invokes the FIEMAP ioctl, walks through the mapped extents
-        and yields mapped block ranges. However, the ranges may be consecutive
-        (e.g., (1, 100), (100, 200)) and 'get_mapped_ranges()' simply merges
-        them.
+        Implements most the functionality for the  '_get_extents()' function:
+        invokes the FIEMAP ioctl, walks through the mapped extents and yields
+        mapped block ranges. Consecutive extents (e.g., (1, 100), (101, 200))
+        are merged on the fly.
         """
 
+        pending = None
         block = start
         while block < start + count:
             struct_fiemap = self._invoke_fiemap(block, count)
@@ -474,12 +606,9 @@ class FilemapFiemap(_FilemapBase):
             mapped_extents = struct_fiemap[3]
             if mapped_extents == 0:
                 # No more mapped blocks
-                return
-
-            extent = 0
-            while extent < mapped_extents:
-                fiemap_extent = self._unpack_fiemap_extent(extent)
+                break
 
+            for fiemap_extent in self._unpack_fiemap_extents(mapped_extents):
                 # Start of the extent
                 extent_start = fiemap_extent[0]
                 # Starting block number of the extent
@@ -494,15 +623,87 @@ class FilemapFiemap(_FilemapBase):
                 assert extent_len % self.block_size == 0
 
                 if extent_block > start + count - 1:
-                    return
+                    block = start + count
+                    break
 
                 first = max(extent_block, block)
                 last = min(extent_block + extent_count, start + count) - 1
-                yield (first, last)
+                if pending is None:
+                    pending = (first, last)
+                elif pending[1] == first - 1:
+                    pending = (pending[0], last)
+                else:
+                    yield pending
+                    pending = (first, last)
+
+                if fiemap_extent[5] & _FIEMAP_EXTENT_LAST:
+                    # This is the last extent of the file
+                    block = start + count
+                    break
+            else:
+                block = extent_block + extent_count
+
+        if pending is not None:
+            yield pending
+
+    def _get_extents(self):
+        """
+        Return the list of mapped block ranges of the entire file in form of
+        '(first, last)' tuples sorted by 'first'. Consecutive ranges are
+        merged. The list is built by the first call and cached, so the FIEMAP
+        ioctl is not invoked again.
+        """
+
+        if self._extents is None:
+            self._extents = list(self._do_get_mapped_ranges(0, self.blocks_cnt))
 
-                extent += 1
+        return self._extents
+
+    def _get_holes(self):
+        """
+        Just like '_get_extents()', but returns the list of unmapped block
+        ranges (holes) of the entire file. The holes are the gaps between the
+        neighbouring mapped extents, so the list is computed in one go.
+        """
 
-            block = extent_block + extent_count
+        if self._holes is None:
+            bounds = [(-1, -1)] + self._get_extents()
+            bounds.append((self.blocks_cnt, self.blocks_cnt))
+            self._holes = [
+                (prev[1] + 1, cur[0] - 1)
+                for prev, cur in zip(bounds, bounds[1:])
+                if cur[0] - prev[1] > 1
+            ]
+
+        return self._holes
+
+    def _get_ranges(self, ranges, start, count):
+        """
+        This function implements 'get_mapped_ranges()' and
+        'get_unmapped_ranges()' depending on whether the 'ranges' list is the
+        list of mapped extents or holes: yields the ranges of the list which
+        overlap with the 'count' blocks starting from block 'start', cut to
+        that area.
+        """
+
+        if count <= 0:
+            return
+
+        self._check_block(start)
+        end = start + count - 1
+
+        index = _find_range(ranges, start)
+        if index < 0 or ranges[index][1] < start:
+            index += 1
+
+        for first, last in ranges[index:]:
+            if first > end:
+                break
+
+            first = max(first, start)
+            last = min(last, end)
+            _log.debug("FilemapFiemap: yielding range (%d, %d)" % (first, last))
+            yield (first, last)
 
     def get_mapped_ranges(self, start, count):
         """Refer to the '_FilemapBase' class for the documentation."""
@@ -510,25 +711,7 @@ class FilemapFiemap(_FilemapBase):
             "FilemapFiemap: get_mapped_ranges(%d,  %d(%d))"
             % (start, count, start + count - 1)
         )
-        iterator = self._do_get_mapped_ranges(start, count)
-
-        try:
-            first_prev, last_prev = next(iterator)
-        except StopIteration:
-            return
-
-        for first, last in iterator:
-            if last_prev == first - 1:
-                last_prev = last
-            else:
-                _log.debug(
-                    "FilemapFiemap: yielding range (%d, %d)" % (first_prev, last_prev)
-                )
-                yield (first_prev, last_prev)
-                first_prev, last_prev = first, last
-
-        _log.debug("FilemapFiemap: yielding range (%d, %d)" % (first_prev, last_prev))
-        yield (first_prev, last_prev)
+        return self._get_ranges(self._get_extents(), start, count)
 
     def get_unmapped_ranges(self, start, count):
         """Refer to the '_FilemapBase' class for the documentation."""
@@ -536,35 +719,38 @@ class FilemapFiemap(_FilemapBase):
             "FilemapFiemap: get_unmapped_ranges(%d,  %d(%d))"
             % (start, count, start + count - 1)
         )
-        hole_first = start
-        for first, last in self._do_get_mapped_ranges(start, count):
-            if first > hole_first:
-                _log.debug(
-                    "FilemapFiemap: yielding range (%d, %d)" % (hole_first, first - 1)
-                )
-                yield (hole_first, first - 1)
+        return self._get_ranges(self._get_holes(), start, count)
 
-            hole_first = last + 1
 
-        if hole_first < start + count:
-            _log.debug(
-                "FilemapFiemap: yielding range (%d, %d)"
-                % (hole_first, start + count - 1)
-            )
-            yield (hole_first, start + count - 1)
+def _find_range(ranges, block):
+    """
+    Return the index of the last range in the sorted 'ranges' list of
+    '(first, last)' tuples which starts at or before block 'block', or '-1' if
+    there is no such range.
+    """
+
+    # A '(block + 1,)' tuple compares greater than every range starting at or
+    # before 'block' and less than every other range.
+    return bisect.bisect_left(ranges, (block + 1,)) - 1
 
 
-def filemap(image):
+def filemap(image, sync=True):
     """
-    Create and return an instance of a Filemap class - 'FilemapFiemap' or
-    'FilemapSeek', depending on what the system we run on supports. If the
-    FIEMAP ioctl is supported, an instance of the 'FilemapFiemap' class is
-    returned. Otherwise, if 'SEEK_HOLE' is supported an instance of the
-    'FilemapSeek' class is returned. If none of these are supported, the
-    function generates an 'Error' type exception.
+    Create and return an instance of a Filemap class - 'FilemapSeek' or
+    'FilemapFiemap', depending on what the system we run on supports. If
+    'SEEK_HOLE' is supported, an instance of the 'FilemapSeek' class is
+    returned. It is preferred because it does not need to copy the extent
+    array out of the kernel and works on file-systems which do not implement
+    the FIEMAP ioctl (e.g., tmpfs). Otherwise, if the FIEMAP ioctl is
+    supported an instance of the 'FilemapFiemap' class is returned. If none of
+    these are supported, the function generates an 'ErrorNotSupp' type
+    exception. The 'sync' argument is passed to the class constructor.
+
+    If 'image' is a path, the returned instance opens the image file itself
+    and has to be closed with 'close()', or used as a context manager.
     """
 
     try:
-        return FilemapFiemap(image)
+        return FilemapSeek(image, sync)
     except ErrorNotSupp:
-        return FilemapSeek(image)
+        return FilemapFiemap(image, sync)
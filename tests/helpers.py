@@ -68,12 +68,10 @@ def _create_random_sparse_file(file_obj, size):
     unmapped = []
     iterator = range(0, blocks_cnt)
     for was_mapped, group in itertools.groupby(iterator, process_block):
-        # Start of a mapped region or a hole. Find the last element in the
-        # group.
+        # Start of a mapped region or a hole. The blocks in the group are
+        # consecutive, so the last one is found by counting the rest of them.
         first = next(group)
-        last = first
-        for last in group:
-            pass
+        last = first + sum(1 for _ in group)
 
         if was_mapped:
             mapped.append((first, last))
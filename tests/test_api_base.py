@@ -57,19 +57,17 @@ def _compare_holes(file1, file2):
     The 'file1' and 'file2' arguments may be full file paths or file objects.
     """
 
-    filemap1 = Filemap.filemap(file1)
-    filemap2 = Filemap.filemap(file2)
+    with Filemap.filemap(file1) as filemap1, Filemap.filemap(file2) as filemap2:
+        iterator1 = filemap1.get_unmapped_ranges(0, filemap1.blocks_cnt)
+        iterator2 = filemap2.get_unmapped_ranges(0, filemap2.blocks_cnt)
 
-    iterator1 = filemap1.get_unmapped_ranges(0, filemap1.blocks_cnt)
-    iterator2 = filemap2.get_unmapped_ranges(0, filemap2.blocks_cnt)
-
-    iterator = zip_longest(iterator1, iterator2)
-    for range1, range2 in iterator:
-        if range1 != range2:
-            raise Error(
-                "mismatch for hole %d-%d, it is %d-%d in file2"
-                % (range1[0], range1[1], range2[0], range2[1])
-            )
+        iterator = zip_longest(iterator1, iterator2)
+        for range1, range2 in iterator:
+            if range1 != range2:
+                raise Error(
+                    "mismatch for hole %d-%d, it is %d-%d in file2"
+                    % (range1[0], range1[1], range2[0], range2[1])
+                )
 
 
 def _generate_compressed_files(file_path, delete=True):
@@ -146,7 +144,8 @@ def _do_test(image, image_size, delete=True):
     """
 
     try:
-        Filemap.filemap(image)
+        with Filemap.filemap(image):
+            pass
     except Filemap.ErrorNotSupp as e:
         sys.stderr.write("%s\n" % e)
         return
@@ -25,12 +25,15 @@ files and makes sure the module returns correct information about the holes.
 # pylint: disable=R0904
 # pylint: disable=R0913
 
+import os
+import gc
 import sys
 import random
 import itertools
+import tempfile
 import tests.helpers
 from itertools import zip_longest
-from bmaptool import Filemap
+from bmaptool import BmapHelpers, Filemap
 
 # This is a work-around for Centos 6
 try:
@@ -100,7 +103,11 @@ def _check_ranges(f_image, filemap, first_block, blocks_cnt, ranges, ranges_type
                 )
             )
 
-        for block in range(correct[0], correct[1] + 1):
+        # The range itself has already been verified above, so there is no
+        # need to probe every block of it - cross-check the first and the last
+        # blocks of the range instead, because this is where off-by-one errors
+        # would show up.
+        for block in (correct[0], correct[1]):
             if ranges_type == "mapped" and filemap.block_is_unmapped(block):
                 raise Error(
                     "range %d-%d of file '%s' is mapped, but"
@@ -138,6 +145,61 @@ def _do_test(f_image, filemap, mapped, unmapped):
         _check_ranges(f_image, filemap, first_block, blocks_cnt, unmapped, "unmapped")
 
 
+def _create_fragmented_file(extents_cnt, directory):
+    """
+    Create a temporary sparse file consisting of 'extents_cnt' single-block
+    mapped extents separated by single-block holes. Returns a tuple
+    containing the file object and the lists of mapped and unmapped block
+    ranges, just like 'tests.helpers.generate_test_files()'.
+    """
+
+    f_image = tempfile.NamedTemporaryFile(
+        "wb+", prefix="fragmented_", dir=directory, suffix=".img"
+    )
+    block_size = BmapHelpers.get_block_size(f_image)
+    f_image.truncate(extents_cnt * 2 * block_size)
+
+    mapped = []
+    unmapped = []
+    for block in range(0, extents_cnt * 2, 2):
+        f_image.seek(block * block_size)
+        f_image.write(b"\xff")
+        mapped.append((block, block))
+        unmapped.append((block + 1, block + 1))
+    f_image.flush()
+
+    return f_image, mapped, unmapped
+
+
+def _compare_filemaps(f_image, fiemap, mapped, unmapped):
+    """
+    Verify that 'get_mapped_ranges()' and 'get_unmapped_ranges()' of the
+    'fiemap' object return the 'mapped' and 'unmapped' lists for the entire
+    file and the same ranges as the 'FilemapSeek' class does.
+    """
+
+    blocks_cnt = fiemap.blocks_cnt
+    with Filemap.FilemapSeek(f_image) as seek:
+        for ranges, fiemap_ranges, seek_ranges in (
+            (
+                mapped,
+                fiemap.get_mapped_ranges(0, blocks_cnt),
+                seek.get_mapped_ranges(0, blocks_cnt),
+            ),
+            (
+                unmapped,
+                fiemap.get_unmapped_ranges(0, blocks_cnt),
+                seek.get_unmapped_ranges(0, blocks_cnt),
+            ),
+        ):
+            fiemap_ranges = list(fiemap_ranges)
+            if fiemap_ranges != ranges or list(seek_ranges) != ranges:
+                raise Error(
+                    "FilemapFiemap and FilemapSeek disagree on the block map "
+                    "of file '%s'" % f_image.name
+                )
+
+
 class TestFilemap(unittest.TestCase):
     """
     The test class for this unit tests. Basically executes the '_do_test()'
@@ -160,10 +222,165 @@ class TestFilemap(unittest.TestCase):
         iterator = tests.helpers.generate_test_files(max_size, directory, delete)
         for f_image, _, mapped, unmapped in iterator:
             try:
-                fiemap = Filemap.FilemapFiemap(f_image)
-                _do_test(f_image, fiemap, mapped, unmapped)
+                with Filemap.FilemapFiemap(f_image) as fiemap:
+                    _do_test(f_image, fiemap, mapped, unmapped)
 
-                seek = Filemap.FilemapSeek(f_image)
-                _do_test(f_image, seek, mapped, unmapped)
+                with Filemap.FilemapSeek(f_image) as seek:
+                    _do_test(f_image, seek, mapped, unmapped)
             except Filemap.ErrorNotSupp:
                 pass
+
+    def test_many_extents(self):
+        """
+        Verify the 'FilemapFiemap' class on a file with more extents than
+        fit the default FIEMAP buffer, so the buffer has to be grown.
+        """
+
+        default_extent_cnt = (
+            Filemap._FIEMAP_BUFFER_SIZE - Filemap._FIEMAP_SIZE
+        ) // Filemap._FIEMAP_EXTENT_SIZE
+        f_image, mapped, unmapped = _create_fragmented_file(
+            default_extent_cnt + 100, "."
+        )
+
+        with f_image:
+            try:
+                fiemap = Filemap.FilemapFiemap(f_image)
+            except Filemap.ErrorNotSupp as err:
+                self.skipTest(str(err))
+
+            with fiemap:
+                self.assertGreater(fiemap._fiemap_extent_cnt, default_extent_cnt)
+                _compare_filemaps(f_image, fiemap, mapped, unmapped)
+
+    def test_small_buffer(self):
+        """
+        Verify the 'FilemapFiemap' class when the extents do not fit the FIEMAP
+        buffer, so that the FIEMAP ioctl has to be invoked several times.
+        """
+
+        f_image, mapped, unmapped = _create_fragmented_file(100, ".")
+
+        with f_image:
+            try:
+                fiemap = Filemap.FilemapFiemap(f_image)
+            except Filemap.ErrorNotSupp as err:
+                self.skipTest(str(err))
+
+            with fiemap:
+                for extent_cnt in (1, 2, 7):
+                    fiemap._fiemap_extent_cnt = extent_cnt
+                    fiemap._extents = None
+                    fiemap._holes = None
+                    _compare_filemaps(f_image, fiemap, mapped, unmapped)
+
+    def test_bad_blocks(self):
+        """
+        Verify that both Filemap classes reject block numbers outside of the
+        image file and return nothing for empty block ranges.
+        """
+
+        f_image, _, _ = _create_fragmented_file(10, ".")
+
+        with f_image:
+            for filemap_class in (Filemap.FilemapFiemap, Filemap.FilemapSeek):
+                try:
+                    filemap = filemap_class(f_image)
+                except Filemap.ErrorNotSupp:
+                    continue
+
+                with filemap:
+                    blocks_cnt = filemap.blocks_cnt
+                    with self.assertRaises(Filemap.Error):
+                        filemap.block_is_mapped(-1)
+                    with self.assertRaises(Filemap.Error):
+                        filemap.block_is_mapped(blocks_cnt)
+                    with self.assertRaises(Filemap.Error):
+                        list(filemap.get_mapped_ranges(blocks_cnt, 1))
+                    with self.assertRaises(Filemap.Error):
+                        list(filemap.get_unmapped_ranges(blocks_cnt, 1))
+
+                    # Block 0 is mapped and block 1 is a hole
+                    for block in (0, 1):
+                        self.assertEqual(list(filemap.get_mapped_ranges(block, 0)), [])
+                        self.assertEqual(
+                            list(filemap.get_unmapped_ranges(block, 0)), []
+                        )
+
+    def test_no_sync(self):
+        """
+        Verify that both Filemap classes and the 'filemap()' function report
+        the correct block map when the image file is not synchronized.
+        """
+
+        f_image, mapped, unmapped = _create_fragmented_file(100, ".")
+
+        with f_image:
+            for create in (
+                Filemap.FilemapFiemap,
+                Filemap.FilemapSeek,
+                Filemap.filemap,
+            ):
+                try:
+                    filemap = create(f_image, sync=False)
+                except Filemap.ErrorNotSupp:
+                    continue
+
+                with filemap:
+                    blocks_cnt = filemap.blocks_cnt
+                    self.assertEqual(
+                        list(filemap.get_mapped_ranges(0, blocks_cnt)), mapped
+                    )
+                    self.assertEqual(
+                        list(filemap.get_unmapped_ranges(0, blocks_cnt)), unmapped
+                    )
+
+    def test_close(self):
+        """
+        Verify that the Filemap classes close the image files they open, and
+        only those.
+        """
+
+        fd_dir = "/proc/self/fd"
+        if not os.path.isdir(fd_dir):
+            self.skipTest("'%s' is not available" % fd_dir)
+
+        f_image, mapped, _ = _create_fragmented_file(10, ".")
+
+        with f_image:
+            for create in (
+                Filemap.FilemapFiemap,
+                Filemap.FilemapSeek,
+                Filemap.filemap,
+            ):
+                try:
+                    create(f_image).close()
+                except Filemap.ErrorNotSupp:
+                    continue
+
+                # An instance opened by path and closed explicitly, twice
+                fds_cnt = len(os.listdir(fd_dir))
+                filemap = create(f_image.name)
+                blocks_cnt = filemap.blocks_cnt
+                self.assertEqual(list(filemap.get_mapped_ranges(0, blocks_cnt)), mapped)
+                filemap.close()
+                filemap.close()
+                self.assertEqual(len(os.listdir(fd_dir)), fds_cnt)
+
+                # A closed instance must not be usable
+                with self.assertRaises(Filemap.Error):
+                    list(filemap.get_mapped_ranges(0, blocks_cnt))
+                with self.assertRaises(Filemap.Error):
+                    filemap.block_is_mapped(0)
+
+                # An instance opened by path and never closed
+                filemap = create(f_image.name)
+                del filemap
+                gc.collect()
+                self.assertEqual(len(os.listdir(fd_dir)), fds_cnt)
+
+                # The file object of the caller must stay open
+                with create(f_image) as filemap:
+                    pass
+                self.assertFalse(f_image.closed)
+                os.fstat(f_image.fileno())